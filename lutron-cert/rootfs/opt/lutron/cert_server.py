@@ -1,15 +1,18 @@
 """
 Server to get Lutron Caseta certificate.
 """
+import asyncio
 import json
 import os
 import re
 import requests
 import socket
 import ssl
+import threading
 
-from flask import (Flask, flash, redirect, render_template, request, session,
-                   url_for)
+from requests.adapters import HTTPAdapter
+
+from flask import Flask, flash, jsonify, redirect, request, session, url_for
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
@@ -20,12 +23,25 @@ from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
 from urllib.parse import urlencode
 
+# Make sure cryptography is using its C OpenSSL backend so CSR signing
+# and certificate parsing get hardware-accelerated SHA-256 where available
+if 'OpenSSL' not in default_backend().openssl_version_text():
+    raise RuntimeError("cryptography is not backed by OpenSSL")
+
 ################################################################################
 
 SSL_PATH = "/ssl/lutron"
 KEY_FILE = "%s/caseta.key" % SSL_PATH
 CERT_FILE = "%s/caseta.crt" % SSL_PATH
 CA_FILE = "%s/caseta-bridge.crt" % SSL_PATH
+SSL_FILES = {'key_file': KEY_FILE,
+             'cert_file': CERT_FILE,
+             'ca_file': CA_FILE}
+
+class FileState:
+    """Cached certificate file checks so wizard() can skip the stat calls."""
+    cert = os.path.isfile(CERT_FILE)
+    ca = os.path.isfile(CA_FILE)
 
 ################################################################################
 
@@ -47,6 +63,8 @@ CERT_SUBJECT = x509.Name([
 BASE_URL = "https://%s/" % LOGIN_SERVER
 REDIRECT_URI = "https://%s/%s" % (LOGIN_SERVER, APP_OAUTH_REDIRECT_PAGE)
 
+OAUTH_CODE_RE = re.compile(r'^(?:.*?code=)?([0-9a-f]*)\s*$')
+
 AUTHORIZE_URL = ("%soauth/authorize?%s" % (BASE_URL,
                                            urlencode({
                                                "client_id": APP_CLIENT_ID,
@@ -54,12 +72,21 @@ AUTHORIZE_URL = ("%soauth/authorize?%s" % (BASE_URL,
                                                "response_type": "code"
                                            })))
 
+# Shared session so the token and pairing requests reuse one TLS connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
 ################################################################################
 
+_PATH_READY = False
+
 def ensure_path():
     """Create SSL path if it does not exist."""
-    if not os.path.isdir(SSL_PATH):
+    global _PATH_READY
+
+    if not _PATH_READY:
         os.makedirs(SSL_PATH, exist_ok=True)
+        _PATH_READY = True
 
 ################################################################################
 
@@ -87,6 +114,8 @@ def get_private_key():
 
 def get_certificate(oauth_code):
     """Get the certificate file used to generate the CA file."""
+    global _SSL_CONTEXT
+
     try:
         with open(CERT_FILE, 'rb') as f:
             certificate = x509.load_pem_x509_certificate(f.read(),
@@ -101,12 +130,14 @@ def get_certificate(oauth_code):
         if not oauth_code:
             raise ValueError("Received invalid OAuth code. Please try again.")
 
-        token = requests.post("%soauth/token" % BASE_URL, data={
+        token = SESSION.post("%soauth/token" % BASE_URL, data={
             'code': oauth_code,
             'client_id': APP_CLIENT_ID,
             'client_secret': APP_CLIENT_SECRET,
             'redirect_uri': REDIRECT_URI,
-            'grant_type': 'authorization_code'}).json()
+            'grant_type': 'authorization_code'},
+            headers={'Accept': 'application/json'},
+            timeout=10).json()
 
         if 'error' in token:
             raise ValueError(token['error_description'])
@@ -122,94 +153,140 @@ def get_certificate(oauth_code):
             csr.public_bytes(serialization.Encoding.PEM).decode('ASCII')
         }
 
-        pairing_response = requests.post(
+        pairing_response = SESSION.post(
             "%sapi/v1/remotepairing/application/user" % BASE_URL,
             json=pairing_request_content,
             headers={
                 'X-DeviceType': 'Caseta,RA2Select',
-                'Authorization': 'Bearer %s' % access_token
-            }
+                'Authorization': 'Bearer %s' % access_token,
+                'Accept': 'application/json'
+            },
+            timeout=10
         ).json()
 
         app_cert = pairing_response['remote_signs_app_certificate']
         remote_cert = pairing_response['local_signs_remote_certificate']
 
         ensure_path()
-        with open(CERT_FILE, 'wb') as f:
-            f.write(app_cert.encode('ASCII'))
-            f.write(remote_cert.encode('ASCII'))
+        tmp_file = "%s.tmp" % CERT_FILE
+        with open(tmp_file, 'wb') as f:
+            f.write((app_cert + remote_cert).encode('ASCII'))
+        os.replace(tmp_file, CERT_FILE)
+
+        FileState.cert = True
+        _SSL_CONTEXT = None
 
 ################################################################################
 
-def get_ca_cert(server_addr):
-    raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ssl_socket = ssl.wrap_socket(raw_socket, keyfile=KEY_FILE,
-                                 certfile=CERT_FILE,
-                                 ssl_version=ssl.PROTOCOL_TLSv1_2)
+_SSL_CONTEXT = None
 
-    ssl_socket.connect((server_addr, 8081))
+def get_ssl_context():
+    """Get the client SSL context used to connect to the bridge."""
+    global _SSL_CONTEXT
 
-    ca_der = ssl_socket.getpeercert(True)
-    ca_cert = x509.load_der_x509_certificate(ca_der, default_backend())
+    if _SSL_CONTEXT is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(CERT_FILE, KEY_FILE)
+        _SSL_CONTEXT = context
 
-    ensure_path()
-    with open(CA_FILE, 'wb') as f:
-        f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+    return _SSL_CONTEXT
 
-    ssl_socket.send(("%s\r\n" % json.dumps({
-        'CommuniqueType': 'ReadRequest',
-        'Header': {'Url': '/server/1/status/ping'}
-    })).encode('UTF-8'))
+################################################################################
 
-    while True:
-        buffer = b''
-        while not buffer.endswith(b'\r\n'):
-            buffer += ssl_socket.read()
+# The LEAP ping request never changes, so serialize and encode it once
+PING_REQUEST = ("%s\r\n" % json.dumps({
+    'CommuniqueType': 'ReadRequest',
+    'Header': {'Url': '/server/1/status/ping'}
+})).encode('ASCII')
 
-        leap_response = json.loads(buffer.decode('UTF-8'))
-        if leap_response['CommuniqueType'] == 'ReadResponse':
-            break
+async def fetch_ca_cert(server_addr):
+    """Save the bridge CA certificate and probe the LEAP server."""
+    # Connect with a bounded timeout and disable Nagle so the small LEAP
+    # writes go out immediately
+    raw_socket = socket.create_connection((server_addr, 8081), timeout=5)
+    raw_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    ssl_socket.close()
+    reader, writer = await asyncio.open_connection(
+        sock=raw_socket, ssl=get_ssl_context(), server_hostname=server_addr)
+
+    try:
+        # The DER from the handshake is already valid, so PEM-wrap it
+        # directly instead of parsing and re-serializing the certificate
+        ca_der = writer.get_extra_info('ssl_object').getpeercert(True)
+
+        ensure_path()
+        with open(CA_FILE, 'wb') as f:
+            f.write(ssl.DER_cert_to_PEM_cert(ca_der).encode('ASCII'))
+
+        FileState.ca = True
+
+        writer.write(PING_REQUEST)
+        await writer.drain()
+
+        while True:
+            line = await asyncio.wait_for(reader.readuntil(b'\r\n'),
+                                          timeout=5)
+
+            leap_response = json.loads(line)
+            if leap_response['CommuniqueType'] == 'ReadResponse':
+                break
+    finally:
+        writer.close()
 
     return leap_response
 
+def get_ca_cert(server_addr):
+    return asyncio.run(fetch_ca_cert(server_addr))
+
 ################################################################################
 
 # Flask webserver
 app = Flask(__name__)
 
 # Flask app config
-with open('/var/lib/dbus/machine-id', 'r') as f:
-    app.secret_key = f.read()
+if not app.secret_key:
+    try:
+        with open('/var/lib/dbus/machine-id', 'r') as f:
+            app.secret_key = f.read()
+    except FileNotFoundError:
+        app.secret_key = os.urandom(32).hex()
+
+# Template objects fetched once so wizard() skips the per-request lookup
+TPL_LOGIN = app.jinja_env.get_template('login.html')
+TPL_BRIDGE = app.jinja_env.get_template('bridge.html')
+TPL_SUCCESS = app.jinja_env.get_template('success.html')
 
 @app.route('/', methods=['GET', 'POST'])
 def wizard():
     """Show the current step based on progress."""
-    if os.path.isfile(CA_FILE):
+    if FileState.ca:
         leap_version = session.get('leap_version')
         if leap_version is not None:
             flash("Successfully connected to bridge, running LEAP Server"
                   "version %s" % leap_version, 'success')
 
-        return render_template(
-            'success.html',
+        return TPL_SUCCESS.render(
             server_addr=session.get('server_addr', '192.168.1.100'),
             ssl_path=SSL_PATH,
-            ssl_files={'key_file': KEY_FILE,
-                       'cert_file': CERT_FILE,
-                       'ca_file': CA_FILE})
+            ssl_files=SSL_FILES)
 
-    if os.path.isfile(CERT_FILE):
-        return render_template(
-            'bridge.html',
+    if FileState.cert:
+        return TPL_BRIDGE.render(
             server_addr=session.get('server_addr', ''))
 
-    return render_template('login.html', authorize_url=AUTHORIZE_URL)
+    return TPL_LOGIN.render(authorize_url=AUTHORIZE_URL)
 
 @app.route('/reset')
 def reset():
     """Delete certificate files and session data."""
+    global _SSL_CONTEXT
+
+    FileState.cert = False
+    FileState.ca = False
+    _SSL_CONTEXT = None
+
     try:
         # Remove certificate files
         os.remove(KEY_FILE)
@@ -230,15 +307,13 @@ def reset():
 @app.route('/debug')
 def debug():
     """Output session data for debugging."""
-    values = {k: v for (k, v) in session.items()}
+    values = dict(session)
     values.update({
         'key_file': (KEY_FILE, os.path.isfile(KEY_FILE)),
         'cert_file': (CERT_FILE, os.path.isfile(CERT_FILE)),
         'ca_file': (CA_FILE, os.path.isfile(CA_FILE)),
     })
-    return app.response_class(response=json.dumps(values),
-                              status=200,
-                              mimetype='application/json')
+    return jsonify(values)
 
 ################################################################################
 
@@ -246,8 +321,7 @@ def debug():
 def process_url():
     """Process the redirect URL."""
     redirected_url = request.form.get('redirected_url')
-    oauth_code = re.sub(r'^(.*?code=){0,1}([0-9a-f]*)\s*$', r'\2',
-                        redirected_url)
+    oauth_code = OAUTH_CODE_RE.sub(r'\1', redirected_url)
 
     try:
         get_certificate(oauth_code)
@@ -269,6 +343,9 @@ def process_addr():
     except ConnectionRefusedError:
         flash("A connection to %s could not be established. Please check "
               "the IP address and try again." % server_addr, 'danger')
+    except (asyncio.TimeoutError, socket.timeout):
+        flash("The bridge at %s did not respond in time. Please check "
+              "the IP address and try again." % server_addr, 'danger')
 
     return redirect(url_for('wizard'))
 
@@ -279,8 +356,13 @@ def main():
     # Make sure SSL_PATH exists
     ensure_path()
 
+    # Pre-generate the private key in the background so the first OAuth
+    # request does not have to wait for it
+    if not os.path.isfile(KEY_FILE):
+        threading.Thread(target=get_private_key, daemon=True).start()
+
     # Start flask server
-    app.run(host='0.0.0.0', port=5817)
+    app.run(host='0.0.0.0', port=5817, threaded=True)
 
 ################################################################################
 